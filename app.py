@@ -1,12 +1,21 @@
 from flask import Flask, jsonify, request
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import delete, event
 from sklearn.linear_model import LinearRegression
 from sklearn.model_selection import train_test_split
 from sklearn.preprocessing import OneHotEncoder
 import pandas as pd
 import numpy as np
 import requests
-from io import BytesIO
+import joblib
+import hashlib
+import itertools
+import math
+import os
+import asyncio
+import tempfile
+import threading
+from requests.adapters import HTTPAdapter
 from flasgger import Swagger
 
 app = Flask(__name__)
@@ -18,6 +27,9 @@ app.config['SWAGGER'] = {
 }
 swagger = Swagger(app)
 
+# Train the model in the background at startup when there is no cached model, opt in with WARM_LOAD=1
+app.config['WARM_LOAD'] = os.environ.get('WARM_LOAD') == '1'
+
 # SQLite DB setup
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///assessments.db'
 db = SQLAlchemy(app)
@@ -31,42 +43,222 @@ class Assessment(db.Model):
     interior_halfbaths = db.Column(db.Integer, nullable=False)
     condition_overallcondition = db.Column(db.String(100), nullable=False)
 
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    # Use write-ahead logging so replacing the whole table on '/reload' costs a single fsync at commit
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute('PRAGMA temp_store=MEMORY')
+    cursor.close()
+
 # Create the database
 with app.app_context():
+    event.listen(db.engine, 'connect', set_sqlite_pragmas)
     db.create_all()
 
+    # Close the connection opened by create_all, so a process forked right after import does not inherit it;
+    # a SQLite connection must not be shared across processes. This only covers import time: anything that
+    # uses the database or the HTTP session before a fork (such as the WARM_LOAD warm-up) reopens connections,
+    # which is why the Procfile does not use gunicorn --preload.
+    db.engine.dispose()
+
 def preprocess_data(df):
     # Clean the assessedvalue column
-    df['assessedvalue'] = df['assessedvalue'].astype(float)
+    df = df.astype({'assessedvalue': float})
 
     # Drop rows where any of the key fields are NaN
     df = df.dropna(subset=['assessedvalue', 'interior_bedrooms', 'interior_fullbaths', 'interior_halfbaths', 'condition_overallcondition'])
 
-    # One more time, fill any missing numerical values with the median, just in case
-    df['interior_bedrooms'] = df['interior_bedrooms'].fillna(df['interior_bedrooms'].median())
-    df['interior_fullbaths'] = df['interior_fullbaths'].fillna(df['interior_fullbaths'].median())
-    df['interior_halfbaths'] = df['interior_halfbaths'].fillna(df['interior_halfbaths'].median())
+    # One more time, fill any missing numerical values with the median and missing categorical values
+    # (condition_overallcondition) with the most frequent value, just in case, in a single pass
+    df = df.fillna({
+        'interior_bedrooms': df['interior_bedrooms'].median(),
+        'interior_fullbaths': df['interior_fullbaths'].median(),
+        'interior_halfbaths': df['interior_halfbaths'].median(),
+        'condition_overallcondition': df['condition_overallcondition'].mode()[0]
+    })
 
-    # Fill missing categorical values (condition_overallcondition) with the most frequent value
-    df['condition_overallcondition'] = df['condition_overallcondition'].fillna(df['condition_overallcondition'].mode()[0])
-
-    # One-hot encode the 'condition_overallcondition' column
+    # Fit the encoder for the '/predict' inputs on the distinct condition_overallcondition values only
     encoder = OneHotEncoder(sparse_output=False)
-    condition_overallcondition_encoded = encoder.fit_transform(df[['condition_overallcondition']])
-
-    # Create a DataFrame for the one-hot encoded overall condition
-    condition_overallcondition_encoded_df = pd.DataFrame(condition_overallcondition_encoded, columns=encoder.get_feature_names_out(['condition_overallcondition']))
+    encoder.fit(df[['condition_overallcondition']].drop_duplicates())
 
-    # Concatenate the encoded condition_overallcondition with the original dataframe
-    df = pd.concat([df, condition_overallcondition_encoded_df], axis=1).drop(columns=['condition_overallcondition'])
-
-    # Drop any rows that still have NaN values at this point (forcefully)
-    df = df.dropna()
+    # One-hot encode the 'condition_overallcondition' column in the same column order as the encoder
+    df['condition_overallcondition'] = pd.Categorical(df['condition_overallcondition'], categories=encoder.categories_[0])
+    df = pd.get_dummies(df, columns=['condition_overallcondition'], dtype=np.float32)
     return df, encoder
 
+def build_model_weights(model, encoder):
+    # Extract the float32 linear weights, plus the one-hot column position of every condition_overallcondition known to the encoder
+    condition_index = {condition: i for i, condition in enumerate(encoder.categories_[0])}
+    return model.coef_.astype(np.float32), float(model.intercept_), condition_index
+
 # Global variables for model and encoder
 model = None
 encoder = None
+data_hash = None
+
+# Linear model weights (float32, like the training features), extracted once after training so '/predict' can skip sklearn's input validation.
+# Published as one (coef, intercept, condition_index) tuple, so a request never mixes weights from two different models.
+model_weights = None
+
+# The fitted model and encoder are cached on disk together with the MD5 of the CSV they were trained on.
+# Bump the version whenever the training code changes, so models fitted by older code are not served.
+model_cache_path = os.path.join(app.instance_path, 'model.joblib')
+model_cache_version = 2
+model_cache_mtime = None
+
+# Serializes training, publishing and caching the model against loading it from the cache
+model_lock = threading.Lock()
+
+def load_cached_model():
+    # Load the model and encoder from the cache whenever it changed, e.g. after another worker process ran '/reload'
+    global model, encoder, data_hash, model_weights, model_cache_mtime
+    try:
+        mtime = os.path.getmtime(model_cache_path)
+    except OSError:
+        return
+    if mtime == model_cache_mtime:
+        return
+
+    with model_lock:
+        # Another thread may have loaded or written this cache while we waited for the lock
+        if mtime == model_cache_mtime:
+            return
+
+        model_cache_mtime = mtime
+        try:
+            version, cached_model, cached_encoder, cached_data_hash = joblib.load(model_cache_path)
+            if version != model_cache_version:
+                app.logger.warning(f"Ignoring cached model from {model_cache_path} with outdated version {version}")
+                return
+            model, encoder, data_hash = cached_model, cached_encoder, cached_data_hash
+            model_weights = build_model_weights(model, encoder)
+        except Exception as e:
+            app.logger.warning(f"Could not load cached model from {model_cache_path}: {e}")
+
+# Warm the model and encoder from the cache so '/predict' works without a prior '/reload'
+load_cached_model()
+
+# Shared HTTP session, so repeated downloads reuse kept-alive connections instead of a new TCP+TLS handshake each time
+http_session = requests.Session()
+http_session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=4))
+
+# Runs the background database writes one at a time, instead of letting them compete for the SQLite write lock.
+# Every write carries the generation of the reload that started it, so an older reload that gets the lock
+# last cannot overwrite newer data.
+persist_lock = threading.Lock()
+persist_generations = itertools.count(1)
+persisted_generation = 0
+
+def persist_assessments(assessments, generation):
+    # Replace the stored assessments with the reloaded data, run in a background thread by '/reload'
+    global persisted_generation
+    try:
+        # Build the row mappings column-wise instead of materializing a Series per row
+        assessedvalue = assessments['assessedvalue'].to_numpy(np.float64)
+        interior_bedrooms = assessments['interior_bedrooms'].to_numpy(np.int64)
+        interior_fullbaths = assessments['interior_fullbaths'].to_numpy(np.float64)
+        interior_halfbaths = assessments['interior_halfbaths'].to_numpy(np.int64)
+        condition_overallcondition = assessments['condition_overallcondition'].to_numpy()
+        mappings = [
+            {
+                'assessedvalue': float(av),
+                'interior_bedrooms': int(bed),
+                'interior_fullbaths': float(fb),
+                'interior_halfbaths': int(hb),
+                'condition_overallcondition': cond
+            }
+            for av, bed, fb, hb, cond in zip(assessedvalue, interior_bedrooms, interior_fullbaths, interior_halfbaths, condition_overallcondition)
+        ]
+
+        with persist_lock:
+            # Skip data from a reload older than the one already stored
+            if generation < persisted_generation:
+                return
+
+            # Clear the database and insert all rows in one bulk operation, within a single transaction
+            with app.app_context(), db.session.begin():
+                # Clear with a plain DELETE statement, skipping ORM row enumeration, and drop any stale cached instances
+                db.session.execute(delete(Assessment))
+                db.session.expire_all()
+                db.session.bulk_insert_mappings(Assessment, mappings)
+            persisted_generation = generation
+    except Exception as e:
+        app.logger.warning(f"Could not store the reloaded assessments in the database: {e}")
+
+# Held around every reload, so a '/reload' waits for a running startup warm-up instead of racing it
+reload_lock = threading.Lock()
+
+def reload_assessments():
+    # Download the data, retrain the model if the data changed and return summary stats, for '/reload' and the startup warm-up.
+    # Callers hold reload_lock.
+    global model, encoder, data_hash, model_weights, model_cache_mtime
+
+    # Step 1 and 2: Stream the data straight into pandas with the multithreaded pyarrow parser, parsing only the columns the model uses
+    url = 'https://data.cambridgema.gov/resource/eey2-rv59.csv?$limit=40000&$offset=150'
+    with http_session.get(url, stream=True, timeout=30) as response:
+        response.raw.decode_content = True
+        assessments = pd.read_csv(
+            response.raw,
+            engine='pyarrow',
+            usecols=['assessedvalue', 'interior_bedrooms', 'interior_fullbaths', 'interior_halfbaths', 'condition_overallcondition'],
+            dtype={
+                'assessedvalue': 'float64',
+                'interior_bedrooms': 'Int32',
+                'interior_fullbaths': 'float32',
+                'interior_halfbaths': 'Int32',
+                'condition_overallcondition': 'category'
+            }
+        )
+    csv_md5 = hashlib.md5(pd.util.hash_pandas_object(assessments, index=False).to_numpy()).hexdigest()
+
+    # Step 3: Process data
+    assessments = assessments.dropna().astype({'interior_bedrooms': 'int64', 'interior_halfbaths': 'int64'})
+
+    # Step 4: Preprocess and train model, unless the current model was already fit on this exact data
+    with model_lock:
+        if model is None or encoder is None or csv_md5 != data_hash:
+            # Fit into locals so other threads never see a half-trained model
+            df, new_encoder = preprocess_data(assessments)
+            X = df.drop(columns='assessedvalue').to_numpy(np.float32)
+            y = df['assessedvalue'].to_numpy(np.float32)
+            new_model = LinearRegression()
+            new_model.fit(X, y)
+
+            model, encoder, data_hash = new_model, new_encoder, csv_md5
+            model_weights = build_model_weights(model, encoder)
+
+            # Write to a unique temporary file first so other workers never load a partially written cache
+            os.makedirs(app.instance_path, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=app.instance_path, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    joblib.dump((model_cache_version, model, encoder, data_hash), f, compress=3)
+                os.replace(tmp_path, model_cache_path)
+            except Exception:
+                os.remove(tmp_path)
+                raise
+            model_cache_mtime = os.path.getmtime(model_cache_path)
+
+    # Step 5: Replace the database contents in the background, since neither training nor '/predict' reads them
+    threading.Thread(target=persist_assessments, args=(assessments, next(persist_generations)), name='persist_assessments', daemon=True).start()
+
+    # Step 6: Generate summary statistics, aggregating the numeric columns in a single pass
+    stats = assessments.agg({
+        'assessedvalue': ['mean', 'min', 'max'],
+        'interior_bedrooms': ['mean'],
+        'interior_fullbaths': ['mean']
+    })
+    summary = {
+        'total_assessments': len(assessments),
+        'average_assessedvalue': float(stats.at['mean', 'assessedvalue']),
+        'min_assessedvalue': float(stats.at['min', 'assessedvalue']),
+        'max_assessedvalue': float(stats.at['max', 'assessedvalue']),
+        'average_interior_bedrooms': float(stats.at['mean', 'interior_bedrooms']),
+        'average_interior_fullbaths': float(stats.at['mean', 'interior_fullbaths']),
+        'top_condition_overallconditions': assessments['condition_overallcondition'].value_counts().head().to_dict()
+    }
+    return summary
 
 @app.route('/reload', methods=['POST'])
 def reload_data():
@@ -77,61 +269,55 @@ def reload_data():
       200:
         description: Summary statistics of reloaded data
     '''
-    global model, encoder
-
-    # Step 1: Download and decompress data
-    url = 'https://data.cambridgema.gov/resource/eey2-rv59.csv?$limit=40000&$offset=150'
-    response = requests.get(url)
-  
-    # Step 2: Load data into pandas
-    assessments = pd.read_csv(BytesIO(response.content))
-
-    # Step 3: Clear the database
-    db.session.query(Assessment).delete()
-
-    # Step 4: Process data and insert it into the database
-    assessments = assessments[['assessedvalue', 'interior_bedrooms', 'interior_fullbaths', 'interior_halfbaths', 'condition_overallcondition']].dropna()
-    assessments['assessedvalue'] = assessments['assessedvalue'].astype(float)
-
-    for _, row in assessments.iterrows():
-        new_assessments = Assessment(
-            assessedvalue=row['assessedvalue'],
-            interior_bedrooms=int(row['interior_bedrooms']),
-            interior_fullbaths=row['interior_fullbaths'],
-            interior_halfbaths=int(row['interior_halfbaths']),
-            condition_overallcondition=row['condition_overallcondition']
-        )
-        db.session.add(new_assessments)
-    db.session.commit()
+    with reload_lock:
+        return jsonify(reload_assessments())
+
+def warm_load():
+    # Load the data and train the model outside of any request, so the first '/predict' after startup doesn't fail
+    with reload_lock, app.app_context():
+        try:
+            reload_assessments()
+        except Exception as e:
+            app.logger.warning(f"Could not load the data at startup: {e}")
+
+# Without a cached model, warm up in the background instead of waiting for the first '/reload'.
+# This runs in every process that imports the app, so it must not be combined with gunicorn --preload,
+# where the warm-up thread would still hold reload_lock in the master when the workers are forked.
+if model is None and app.config['WARM_LOAD']:
+    threading.Thread(target=warm_load, daemon=True).start()
+
+# Define the set of valid condition_overallcondition and the error message listing them
+valid_condition_overallcondition = frozenset({
+    "Average", "Excellent", "Fair", "Good", "Poor", "Superior", "Very Good"
+})
+invalid_condition_overallcondition_error = f"Invalid condition_overallcondition. Please choose one of the following: {', '.join(sorted(valid_condition_overallcondition))}"
+
+def to_number(value):
+    # Convert a JSON value to a float, returning None for missing, non-numeric or non-finite (NaN, infinite) values
+    try:
+        number = float(value)
+    except (TypeError, ValueError, OverflowError):
+        return None
+    return number if math.isfinite(number) else None
 
-    # Step 5: Preprocess and train model
-    df, encoder = preprocess_data(assessments)
-    X = df.drop(columns='assessedvalue')
-    y = df['assessedvalue']
-    model = LinearRegression()
-    model.fit(X, y)
+# Handing work to a thread costs ~40-50 us, while the dot product for 10k rows takes ~30 us, so only
+# batches at least this large are offloaded; smaller ones are predicted inline
+offload_batch_size = 50000
 
-    # Step 6: Generate summary statistics
-    summary = {
-        'total_assessments': len(assessments),
-        'average_assessedvalue': assessments['assessedvalue'].mean(),
-        'min_assessedvalue': assessments['assessedvalue'].min(),
-        'max_assessedvalue': assessments['assessedvalue'].max(),
-        'average_interior_bedrooms': assessments['interior_bedrooms'].mean(),
-        'average_interior_fullbaths': assessments['interior_fullbaths'].mean(),
-        'top_condition_overallconditions': assessments['condition_overallcondition'].value_counts().head().to_dict()
-    }
+def compute_predictions(input_data, coef, intercept):
+    # Linear regression inference is just the dot product of the features with the fitted weights
+    return input_data @ coef + intercept
 
-    return jsonify(summary)
 @app.route('/predict', methods=['POST'])
-def predict():
+async def predict():
     '''
-    Predict the assessed value for a single family home in Cambridge based on the input features
+    Predict the assessed value for one or more single family homes in Cambridge based on the input features
     ---
     parameters:
       - name: body
         in: body
         required: true
+        description: A single home, or a list of homes to predict in one batch
         schema:
           type: object
           properties:
@@ -145,49 +331,66 @@ def predict():
               type: string
     responses:
       200:
-        description: Predicted assessed value
+        description: Predicted assessed value, or a list of predicted assessed values when a list was posted
     '''
-    global model, encoder  # Ensure that the encoder and model are available for prediction
+    global model_weights  # Ensure that the model weights are available for prediction
+
+    # Pick up a model trained by another worker process
+    load_cached_model()
 
-    # Define the list of valid condition_overallcondition
-    valid_condition_overallcondition = [
-        "Average", "Excellent", "Fair", "Good", "Poor", "Superior", "Very Good"
-    ]
+    # Read the weights once, so a concurrent reload cannot swap them in the middle of this request
+    weights = model_weights
 
-    # Check if the model and encoder are initialized
-    if model is None or encoder is None:
+    # Check if the model is initialized
+    if weights is None:
         return jsonify({"error": "The data has not been loaded. Please refresh the data by calling the '/reload' endpoint first."}), 400
+    coef, intercept, condition_index = weights
 
     data = request.json
+    records = data if isinstance(data, list) else [data]
     try:
-        interior_bedrooms = pd.to_numeric(data.get('interior_bedrooms'), errors='coerce')
-        interior_fullbaths = pd.to_numeric(data.get('interior_fullbaths'), errors='coerce')
-        interior_halfbaths = pd.to_numeric(data.get('interior_halfbaths'), errors='coerce')
-        condition_overallcondition = data.get('condition_overallcondition')
-
-        if None in [interior_bedrooms, interior_fullbaths, interior_halfbaths, condition_overallcondition]:
+        if not records or not all(isinstance(record, dict) for record in records):
             return jsonify({"error": "Missing or invalid required parameters"}), 400
 
-        # Check if the condition_overallcondition is valid
-        if condition_overallcondition not in valid_condition_overallcondition:
-            return jsonify({"error": f"Invalid condition_overallcondition. Please choose one of the following: {', '.join(valid_condition_overallcondition)}"}), 400
+        # Fill a pre-allocated feature matrix with the numeric and encoded columns
+        input_data = np.empty((len(records), len(coef)), dtype=np.float32)
+        for i, record in enumerate(records):
+            interior_bedrooms = to_number(record.get('interior_bedrooms'))
+            interior_fullbaths = to_number(record.get('interior_fullbaths'))
+            interior_halfbaths = to_number(record.get('interior_halfbaths'))
+            condition_overallcondition = record.get('condition_overallcondition')
+
+            if condition_overallcondition is None:
+                return jsonify({"error": "Missing or invalid required parameters"}), 400
+
+            # Check if the condition_overallcondition is valid
+            if not isinstance(condition_overallcondition, str) or condition_overallcondition not in valid_condition_overallcondition:
+                return jsonify({"error": invalid_condition_overallcondition_error}), 400
+
+            # Check for missing or non-numeric values in the converted inputs
+            if interior_bedrooms is None or interior_fullbaths is None or interior_halfbaths is None:
+                return jsonify({"error": "Invalid numeric values for interior_bedrooms, interior_fullbaths, or interior_halfbaths"}), 400
 
-        # Check for NaN values in the converted inputs
-        if pd.isna(interior_bedrooms) or pd.isna(interior_fullbaths) or pd.isna(interior_halfbaths):
-            return jsonify({"error": "Invalid numeric values for interior_bedrooms, interior_fullbaths, or interior_halfbaths"}), 400
+            # One-hot encode the condition_overallcondition by setting its column directly instead of calling the encoder
+            if condition_overallcondition not in condition_index:
+                raise ValueError(f"Found unknown condition_overallcondition '{condition_overallcondition}' that the model was not trained on")
 
-        # Transform the input using the global encoder
-        condition_overallcondition_encoded = encoder.transform([[condition_overallcondition]])
-        input_data = np.concatenate(([interior_bedrooms, interior_fullbaths, interior_halfbaths], condition_overallcondition_encoded[0]))
-        input_data = input_data.reshape(1, -1)
+            input_data[i, :3] = (interior_bedrooms, interior_fullbaths, interior_halfbaths)
+            input_data[i, 3:] = 0.0
+            input_data[i, 3 + condition_index[condition_overallcondition]] = 1.0
 
-        # Predict the assessedvalue
-        predicted_assessedvalue = model.predict(input_data)[0]
+        # Predict the assessedvalue for every input at once, off the event loop for large batches
+        if len(input_data) >= offload_batch_size:
+            predicted_assessedvalues = await asyncio.to_thread(compute_predictions, input_data, coef, intercept)
+        else:
+            predicted_assessedvalues = compute_predictions(input_data, coef, intercept)
 
-        return jsonify({"predicted_assessedvalue": predicted_assessedvalue})
+        if isinstance(data, list):
+            return jsonify({"predicted_assessedvalues": predicted_assessedvalues.tolist()})
+        return jsonify({"predicted_assessedvalue": float(predicted_assessedvalues[0])})
 
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 if __name__ == '__main__':
-    app.run(debug=True)
+    app.run(debug=True, threaded=True)
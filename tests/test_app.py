@@ -1,5 +1,9 @@
+import os
+import threading
+import pandas as pd
 import pytest
-from app import app, db
+import app as app_module
+from app import app, db, model_cache_path, Assessment, persist_assessments, persist_generations
 
 # Define valid input for prediction test
 valid_input = {
@@ -77,3 +81,87 @@ def test_missing_fields(client):
     json_data = response.get_json()
     assert "Invalid numeric values for interior_bedrooms, interior_fullbaths, or interior_halfbaths" in json_data['error']
 
+
+def test_reload_caches_model(client):
+    """Test that reloading the data writes the fitted model to the on-disk cache."""
+    response = client.post('/reload')
+    assert response.status_code == 200
+    assert os.path.exists(model_cache_path)
+    model = app_module.model
+
+    # A second reload of the same data should skip the refit and keep serving predictions
+    client.post('/reload')
+    assert app_module.model is model
+    response = client.post('/predict', json=valid_input)
+    assert response.status_code == 200
+
+def test_predict_batch(client):
+    """Test prediction endpoint with a list of inputs."""
+    # Reload the data first
+    client.post('/reload')
+
+    response = client.post('/predict', json=[valid_input, valid_input])
+    assert response.status_code == 200
+    json_data = response.get_json()
+    assert len(json_data['predicted_assessedvalues']) == 2
+
+    # A single invalid input rejects the whole batch
+    response = client.post('/predict', json=[valid_input, invalid_condition_overallcondition_input])
+    assert response.status_code == 400
+
+def test_non_finite_numeric_values(client):
+    """Test prediction with numeric values that overflow to infinity."""
+    # Reload the data first
+    client.post('/reload')
+
+    for value in ["1e400", "inf", "-Infinity"]:
+        response = client.post('/predict', json=dict(valid_input, interior_bedrooms=value))
+        assert response.status_code == 400
+        json_data = response.get_json()
+        assert "Invalid numeric values for interior_bedrooms, interior_fullbaths, or interior_halfbaths" in json_data['error']
+
+def test_predict_after_rejected_inputs(client):
+    """Test that predictions are unaffected by earlier requests rejected with a 400."""
+    # Reload the data first
+    client.post('/reload')
+    expected = client.post('/predict', json=valid_input).get_json()['predicted_assessedvalue']
+
+    assert client.post('/predict', json=invalid_condition_overallcondition_input).status_code == 400
+    assert client.post('/predict', json=missing_field_input).status_code == 400
+    assert client.post('/predict', json=[valid_input, missing_field_input]).status_code == 400
+
+    response = client.post('/predict', json=valid_input)
+    assert response.status_code == 200
+    assert response.get_json()['predicted_assessedvalue'] == expected
+
+
+def test_reload_persists_assessments(client):
+    """Test that the reloaded data is stored in the database once the background write finishes."""
+    response = client.post('/reload')
+    total_assessments = response.get_json()['total_assessments']
+
+    for thread in threading.enumerate():
+        if thread.name == 'persist_assessments':
+            thread.join()
+
+    with app.app_context():
+        assert db.session.query(Assessment).count() == total_assessments
+
+
+def test_stale_persist_is_skipped(client):
+    """Test that data from an older reload never overwrites data from a newer one."""
+    def assessments(n):
+        return pd.DataFrame({
+            'assessedvalue': [500000.0] * n,
+            'interior_bedrooms': [3] * n,
+            'interior_fullbaths': [2.0] * n,
+            'interior_halfbaths': [1] * n,
+            'condition_overallcondition': ['Good'] * n
+        })
+
+    older, newer = next(persist_generations), next(persist_generations)
+    persist_assessments(assessments(3), newer)
+    persist_assessments(assessments(5), older)
+
+    with app.app_context():
+        assert db.session.query(Assessment).count() == 3